@@ -1,12 +1,40 @@
 #!/usr/bin/python
 
-import subprocess
+import fcntl
+import os
 import random
-import mosquitto
 import serial
+import socket
 import time
 import re
+import struct
 import logging
+import subprocess
+
+try:
+	import paho.mqtt.client as mqtt
+except ImportError:
+	mqtt = None # falls back to mosquitto_pub
+
+# time.monotonic is Python 3 only
+_monotonic = getattr(time, "monotonic", time.time)
+
+# 1-0:1.8.1*255(0001798.478*kWh)
+_EXTRACT_RE = re.compile(r"^(?:\d-\d:)?(\S+\.\S+\.\d+)(?:\*255)?\(([^)]+)\)", re.MULTILINE)
+
+def _bcc(buf):
+	# XOR parity is associative: fold 8-byte words first, then the tail
+	n = len(buf) & ~7
+	acc = 0
+	for word in struct.unpack_from("<%dQ" % (n // 8), buf):
+		acc ^= word
+	for b in bytearray(buf[n:]):
+		acc ^= b
+	x = 0
+	while acc:
+		x ^= acc & 0xff
+		acc >>= 8
+	return x
 
 
 class FakeMeter:
@@ -55,6 +83,10 @@ class MT174:
 	STX = '\x02'
 	ETX = '\x03'
 	DELAY = 0.02
+	TIOCGSERIAL = 0x541E
+	TIOCSSERIAL = 0x541F
+	ASYNC_LOW_LATENCY = 0x2000
+	LATENCY_TIMER = "/sys/bus/usb-serial/devices/%s/latency_timer"
 
 	def __init__(self, port):
 		self.__port = port
@@ -63,11 +95,32 @@ class MT174:
 	@staticmethod
 	def __delay():
 		time.sleep(MT174.DELAY)
+
+	@staticmethod
+	def __setLowLatency(mt174, port):
+		# struct serial_struct: flags is the 5th int
+		try:
+			buf = bytearray(fcntl.ioctl(mt174.fileno(), MT174.TIOCGSERIAL, b"\0" * 0x48))
+			flags, = struct.unpack_from("i", buf, 16)
+			struct.pack_into("i", buf, 16, flags | MT174.ASYNC_LOW_LATENCY)
+			fcntl.ioctl(mt174.fileno(), MT174.TIOCSSERIAL, bytes(buf))
+			logging.debug("Set low latency on %s", port)
+			return
+		except (IOError, OSError):
+			pass
+		try:
+			tty = os.path.basename(os.path.realpath(port))
+			with open(MT174.LATENCY_TIMER % tty, "w") as f:
+				f.write("1")
+			logging.debug("Set latency timer on %s", port)
+		except (IOError, OSError):
+			logging.debug("Unable to set low latency on %s", port)
 	
 	def read(self):
 		logging.debug("Opening serial port %s", self.__port)
 		mt174 = serial.Serial(port = self.__port, baudrate=300, bytesize=7, parity='E', stopbits=1, timeout=1.5);
 		try:
+			MT174.__setLowLatency(mt174, self.__port)
 			# 1 ->
 			logging.debug("Writing hello message")
 			message = '/?!\r\n' # IEC 62056-21:2002(E) 6.3.1
@@ -89,27 +142,28 @@ class MT174:
 			# 4 <-
 			datablock = ""
 			if mt174.read() == MT174.STX:
-				x = mt174.read()
-				if len(x) == 0:
-					raise Exception("Empty string instead of data")
-				BCC = 0
-				while x != '!':
-					BCC = BCC ^ ord(x)
-					datablock = datablock + x
-					x = mt174.read()
-					if len(x) == 0:
-						raise Exception("Empty string instead of data")
-				while x != MT174.ETX:
-					BCC = BCC ^ ord(x) # ETX itself is part of block check
-					x = mt174.read()
+				block = ""
+				end = -1
+				while end == -1 or len(block) <= end + 1:
+					# take whatever is buffered, block for at least one byte otherwise
+					x = mt174.read(mt174.inWaiting() or 1)
 					if len(x) == 0:
 						raise Exception("Empty string instead of data")
-				BCC = BCC ^ ord(x)
-				x = mt174.read() # x is now the Block Check Character
+					if end == -1:
+						end = x.find(MT174.ETX)
+						if end != -1:
+							end = end + len(block)
+					block = block + x
+				x = block[end + 1] # x is now the Block Check Character
+				block = block[:end + 1] # ETX itself is part of block check
 				# last character is read, could close connection here
+				BCC = _bcc(block)
 				if (BCC != ord(x)): # received correctly?
-					datablock = ""
 					raise Exception("Result not OK, try again")
+				end = block.find('!')
+				if end == -1:
+					raise Exception("No end of data found")
+				datablock = block[:end]
 			else:
 				logging.warning("No STX found, not handled")
 			return datablock
@@ -119,8 +173,6 @@ class MT174:
 
 class Scheduler:
 
-	SLEEP_TIME = 0.1
-
 	def __init__(self, mt174, processors, interval = 60):
 		self.__mt174 = mt174
 		self.__processors = processors
@@ -128,18 +180,22 @@ class Scheduler:
 		logging.info("Created scheduler, interval = %ds", interval)
 	
 	def execute(self, timestamp):
+		timed = logging.getLogger().isEnabledFor(logging.INFO)
 		try:
-			begin = time.time()
+			if timed:
+				begin = _monotonic()
 			data = self.__mt174.read()
-			end = time.time()
-			logging.info("Read data in %.3fs", (end - begin))
+			if timed:
+				logging.info("Read data in %.3fs", (_monotonic() - begin))
 			logging.debug("Data: %s", data)
+			parsed = Processor.extract(data)
 			for p in self.__processors:
 				try:
-					begin = time.time()
-					p.process(timestamp, data)
-					end = time.time()
-					logging.info("Processor (%s) in %.3fs", p.getName(), (end - begin))
+					if timed:
+						begin = _monotonic()
+					p.process(timestamp, data, parsed)
+					if timed:
+						logging.info("Processor (%s) in %.3fs", p.getName(), (_monotonic() - begin))
 				except KeyboardInterrupt:
 					raise
 				except Exception:
@@ -153,8 +209,9 @@ class Scheduler:
 		start = 0
 		try:
 			while True:
-				while (time.time() - start) < self.__interval:
-					time.sleep(Scheduler.SLEEP_TIME)
+				delay = start + self.__interval - time.time()
+				if delay > 0:
+					time.sleep(delay)
 				start = time.time()
 				self.execute(start)
 		except KeyboardInterrupt:
@@ -162,12 +219,17 @@ class Scheduler:
 		except Exception:
 			logging.exception("Error. Exiting...")
 			return 1
+		finally:
+			for p in self.__processors:
+				try:
+					p.close()
+				except Exception:
+					logging.exception("Error closing processor")
 
 class Processor:
 
-	# 1-0:1.8.1*255(0001798.478*kWh)
-	REGEX = re.compile("(?:\d\-\d:)?(\S+\.\S+\.\d+)(?:\*255)?\((.+)\)")
-	
+	REGEX = _EXTRACT_RE
+
 	def __init__(self, name):
 		self.__name = name
 
@@ -176,134 +238,198 @@ class Processor:
 
 	@staticmethod
 	def extract(data):
-		d = dict()
-		for line in data.split():
-			match = Processor.REGEX.match(line)
-			if match:
-				d[match.group(1)] = match.group(2)
-		return d
+		return dict(_EXTRACT_RE.findall(data))
 			
-	def process(self, timestamp, data):
+	def process(self, timestamp, data, parsed):
+		pass
+
+	def close(self):
 		pass
 
 class MqttProcessor(Processor):
 
 	MARGIN_PERCENT = 0.5
-	
+
 	MOSQUITTO_PUB = "/usr/bin/mosquitto_pub"
 
 	def __init__(self, host, port, rootTopic, interval):
 		Processor.__init__(self, "mqtt")
 		self.__last = [0, (0,0,0)]
-		self.__host = host
-		self.__port = port
 		self.__rootTopic = rootTopic
 		self.__interval = interval + interval * MqttProcessor.MARGIN_PERCENT
+		self.__client = None
+		self.__pipes = {}
+		self.__clientIds = {}
+		self.__devnull = None
+		self.__command = [MqttProcessor.MOSQUITTO_PUB, "-h", host, "-p", str(port)]
+		if mqtt is not None:
+			self.__client = mqtt.Client(client_id = self.getName())
+			self.__client.connect_async(host, port, keepalive = 120)
+			self.__client.loop_start()
 		logging.info("Created MQTT (%s), host = %s, port = %d", self.getName(), host, port)
 
-	def buildCommand(self, topic, value):
-		command = [MqttProcessor.MOSQUITTO_PUB]
-		command.extend(["-i", "%s" % self.getName()])
-		command.extend(["-h", "%s" % self.__host])
-		command.extend(["-p", "%d" % self.__port])
-		command.extend(["-t", "%s/%s" % (self.__rootTopic, topic)])
-		command.extend(["-m", "%s" % value])
-		return command
-
-	def executeCommand(self, command):
-		with open("/dev/null", "w") as f:
-			logging.debug("Executing: %s" % " ".join(command))
-			retcode = subprocess.call(command, stdout = f, stderr = f)
-			if retcode != 0:
-				logging.error("Unable to execute command")
-			return retcode
-
-	def process(self, timestamp, data):
-		d = Processor.extract(data)
+	def _publish(self, topic, payload):
+		topic = "%s/%s" % (self.__rootTopic, topic)
+		logging.debug("Publishing: %s %s", topic, payload)
+		if self.__client is not None:
+			info = self.__client.publish(topic, payload, qos = 0)
+			if info.rc != mqtt.MQTT_ERR_SUCCESS:
+				logging.error("Unable to publish %s: %s", topic, mqtt.error_string(info.rc))
+		else:
+			pipe = self.__pipe(topic)
+			pipe.stdin.write(payload + "\n")
+			pipe.stdin.flush()
+
+	def __pipe(self, topic):
+		# One long-lived mosquitto_pub per topic, reading messages from stdin
+		pipe = self.__pipes.get(topic)
+		if pipe is None or pipe.poll() is not None:
+			clientId = self.__clientIds.setdefault(topic, "%s-%d" % (self.getName(), len(self.__clientIds)))
+			command = self.__command + ["-i", clientId, "-t", topic, "-l"]
+			logging.debug("Starting: %s", command)
+			if self.__devnull is None:
+				self.__devnull = open(os.devnull, "wb")
+			pipe = subprocess.Popen(command, stdin = subprocess.PIPE, stdout = self.__devnull, stderr = self.__devnull, universal_newlines = True)
+			self.__pipes[topic] = pipe
+		return pipe
+
+	def close(self):
+		if self.__client is not None:
+			self.__client.disconnect()
+			self.__client.loop_stop()
+		for pipe in self.__pipes.values():
+			pipe.stdin.close()
+			pipe.wait()
+		self.__pipes = {}
+		if self.__devnull is not None:
+			self.__devnull.close()
+			self.__devnull = None
+
+	def process(self, timestamp, data, parsed):
 		edis = ("1.8.0", "1.8.1", "1.8.2")
 		names = ("total", "tariff1", "tariff2")
-		index = [float(d[x].split("*")[0]) for x in d if x in edis]
+		index = [float(parsed[x].partition("*")[0]) for x in edis]
 		current = [timestamp, index]
+		prefix = "%d " % timestamp
 		# current
 		if self.__last[0] != 0:
 			interval = current[0] - self.__last[0]
 			if interval < self.__interval:
-				func = lambda x,y: (x - y) * 3600. / interval
-				values = map(func, current[1], self.__last[1])
-				for key, value in zip(names, values):
-					message = "%d %.3f" % (timestamp, value)
+				scale = 3600. / interval
+				last = self.__last[1]
+				for i, key in enumerate(names):
+					value = (index[i] - last[i]) * scale
+					message = prefix + "%.3f" % value
 					topic = "current/%s" % key
-					command = self.buildCommand(topic, message)
-					self.executeCommand(command)
+					self._publish(topic, message)
 			else:
-				logging.error("Interval too long: %.2f" % interval)
+				logging.error("Interval too long: %.2f", interval)
 		# index
 		for key, value in zip(names, index):
-			message = "%d %.3f" % (timestamp, value)
+			message = prefix + "%.3f" % value
 			topic = "index/%s" % key
-			command = self.buildCommand(topic, message)
-			self.executeCommand(command)
+			self._publish(topic, message)
 			logging.info("%s = %.3f kWh", topic, value)
 		# power down counter
-		message = "%d %d" % (timestamp, int(d["C.7.0"]))
+		message = prefix + "%d" % int(parsed["C.7.0"])
 		topic = "powerdown/counter"
-		command = self.buildCommand(topic, message)
-		self.executeCommand(command)
+		self._publish(topic, message)
 
 		self.__last = current
 
 class EibdProcessor(Processor):
-	
-	GROUPWRITE = "/usr/local/bin/groupwrite"
+
+	EIBD_PORT = 6720
+	EIB_OPEN_GROUPCON = 0x0026
+	EIB_GROUP_PACKET = 0x0027
+	A_GROUPVALUE_WRITE = 0x0080
 
 	def __init__(self, host):
 		Processor.__init__(self, "eibd")
 		self.__host = host
+		self.__sock = None # connected on first write
 		logging.info("Created EIBD (%s), host = %s", self.getName(), host)
-	
+
 	@staticmethod
-	def convertTo4Bytes(value):
-		if value < 0:
-			raise Exception("Value smaller than 0: %d", value)
-		elif value > 2147483647:
-			raise Exception("Value greater than 2147483647: %d", value)
+	def __connect(host):
+		# Same URL format as the eibd tools: local:/path or ip:host[:port]
+		if host.startswith("local:"):
+			sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			sock.connect(host[6:])
+		elif host.startswith("ip:"):
+			address = host[3:].split(":")
+			port = int(address[1]) if len(address) > 1 else EibdProcessor.EIBD_PORT
+			sock = socket.create_connection((address[0], port))
 		else:
-			number = "{0:0{1}x}".format(value, 8)
-			return ["0x" + number[i:i+2] for i in xrange(0, len(number), 2)]
-
-	def buildCommand(self, groupAddress, bytes):
-		command = [EibdProcessor.GROUPWRITE]
-		command.append("%s" % self.__host)
-		command.append("%s" % groupAddress)
-		command.extend(bytes)
-		return command
-
-	def executeCommand(self, command):
-		with open("/dev/null", "w") as f:
-			logging.debug("Executing: %s" % " ".join(command))
-			#retcode = subprocess.call(command, stdout = f, stderr = f)
-			retcode = 0
-			if retcode != 0:
-				logging.error("Unable to execute command")
-			return retcode
-
-	def process(self, timestamp, data):
-		d = Processor.extract(data)
+			raise Exception("Unsupported eibd URL: %s" % host)
+		return sock
+
+	def __open(self):
+		self.__sock = EibdProcessor.__connect(self.__host)
+		self.__send(struct.pack(">HHB", EibdProcessor.EIB_OPEN_GROUPCON, 0, 0xff)) # write only
+		reply = self.__receive()
+		if struct.unpack(">H", reply[:2])[0] != EibdProcessor.EIB_OPEN_GROUPCON:
+			raise IOError("Unable to open group connection")
+		logging.debug("Opened group connection to %s", self.__host)
+
+	@staticmethod
+	def convertGroupAddress(groupAddress):
+		main, middle, sub = [int(x) for x in groupAddress.split("/")]
+		return ((main & 0x1f) << 11) | ((middle & 0x07) << 8) | (sub & 0xff)
+
+	@staticmethod
+	def convertTo4Bytes(value):
+		if not 0 <= value <= 2147483647:
+			raise ValueError("Value out of range [0, 2147483647]: %d" % value)
+		return struct.pack(">I", value)
+
+	def __send(self, message):
+		self.__sock.sendall(struct.pack(">H", len(message)) + message)
+
+	def __receive(self):
+		size = struct.unpack(">H", self.__receiveAll(2))[0]
+		return self.__receiveAll(size)
+
+	def __receiveAll(self, size):
+		data = b""
+		while len(data) < size:
+			x = self.__sock.recv(size - len(data))
+			if len(x) == 0:
+				raise IOError("Connection to eibd closed")
+			data = data + x
+		return data
+
+	def _groupWrite(self, groupAddress, data):
+		logging.debug("Group write: %s %r", groupAddress, data)
+		address = EibdProcessor.convertGroupAddress(groupAddress)
+		try:
+			if self.__sock is None:
+				self.__open()
+			self.__send(struct.pack(">HHH", EibdProcessor.EIB_GROUP_PACKET, address, EibdProcessor.A_GROUPVALUE_WRITE) + data)
+		except (socket.error, IOError):
+			# reconnect on the next write
+			self.close()
+			raise
+
+	def process(self, timestamp, data, parsed):
 		edis = ("1.8.0", "1.8.1", "1.8.2")
 		ga = ("14/1/0", "14/1/1", "14/1/2")
-		index = [float(d[x].split("*")[0]) for x in d if x in edis]
+		index = [float(parsed[x].partition("*")[0]) for x in edis]
 		# index
 		for key, value in zip(ga, index):
 			Wh = int(value * 1000)
-			command = self.buildCommand(key, EibdProcessor.convertTo4Bytes(Wh))
-			self.executeCommand(command)
+			self._groupWrite(key, EibdProcessor.convertTo4Bytes(Wh))
 			logging.info("%s = %d Wh", key, Wh)
 		# power down counter
 		key = "14/1/3"
-		value = int(d["C.7.0"])
-		command = self.buildCommand(key, [hex(value)])
+		value = int(parsed["C.7.0"])
 		logging.info("%s = %d times", key, value)
-		self.executeCommand(command)
+		self._groupWrite(key, struct.pack(">B", value))
+
+	def close(self):
+		if self.__sock is not None:
+			self.__sock.close()
+			self.__sock = None
 
 
 class FileLogger(Processor):
@@ -311,24 +437,38 @@ class FileLogger(Processor):
 	def __init__(self, filename):
 		Processor.__init__(self, "file-logger")
 		self.__filename = filename
+		self.__cached = (None, None)
+		self.__file = None
 		logging.info("Created FileLogger, filename = %s", filename)
 
-	def process(self, timestamp, data):
-		filename = "%s-%s.log" % (self.__filename, time.strftime("%Y-%m"))
-		with open(filename, "a+") as f:
-			f.write("%d: %s\n" % (timestamp, Processor.extract(data)))
-			logging.debug("Written data to %s", filename)
-
-
-logging.basicConfig(format = "%(levelname)s: %(message)s")
-logging.getLogger().setLevel(logging.DEBUG)
-
-interval = 60
-m = MT174("/dev/ttyUSB0")
-#m = FakeMeter()
-#p = (Logger(),)
-#p = (MqttProcessor("localhost", 1883, "/home/energy", interval), FileLogger("/tmp/data"))
-p = (EibdProcessor("local:/tmp/eib"), FileLogger("/tmp/data"))
-s = Scheduler(m, p, interval)
-s.run()
-
+	def process(self, timestamp, data, parsed):
+		tm = time.localtime(timestamp)
+		month = (tm.tm_year, tm.tm_mon)
+		if month != self.__cached[0]:
+			self.__cached = (month, "%s-%04d-%02d.log" % (self.__filename, month[0], month[1]))
+			self.close()
+		filename = self.__cached[1]
+		if self.__file is None:
+			self.__file = open(filename, "a", 1) # line buffered
+			logging.debug("Opened %s", filename)
+		self.__file.write("%d: %s\n" % (timestamp, parsed))
+		logging.debug("Written data to %s", filename)
+
+	def close(self):
+		if self.__file is not None:
+			self.__file.close()
+			self.__file = None
+
+
+if __name__ == "__main__":
+	logging.basicConfig(format = "%(levelname)s: %(message)s")
+	logging.getLogger().setLevel(logging.INFO)
+
+	interval = 60
+	m = MT174("/dev/ttyUSB0")
+	#m = FakeMeter()
+	#p = (Logger(),)
+	#p = (MqttProcessor("localhost", 1883, "/home/energy", interval), FileLogger("/tmp/data"))
+	p = (EibdProcessor("local:/tmp/eib"), FileLogger("/tmp/data"))
+	s = Scheduler(m, p, interval)
+	s.run()